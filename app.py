@@ -1,7 +1,17 @@
 # app.py
 import os
+import re
+import sys
 import json
+import math
+import hashlib
+import tempfile
+import time
 import uuid
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from pathlib import Path
 import streamlit as st
@@ -28,6 +38,20 @@ OPENAI_API_KEY = st.secrets.get("OPENAI_API_KEY", os.getenv("OPENAI_API_KEY", ""
 DEFAULT_MODEL = st.secrets.get("OPENAI_MODEL", os.getenv("OPENAI_MODEL", "gpt-4.1-mini"))
 
 
+def int_setting(name: str, default: int) -> int:
+    # кривое значение в secrets/env не должно ронять приложение на импорте
+    try:
+        return int(str(st.secrets.get(name, os.getenv(name, default))).strip())
+    except (TypeError, ValueError):
+        return default
+
+
+# бюджет входа (system + данные) в токенах; 0 = без ограничения
+PROMPT_TOKEN_BUDGET = int_setting("PROMPT_TOKEN_BUDGET", 1200)
+# адаптивный режим: пропускаем вопросы, которые уже не могут поменять топ-потенциал позиции
+ADAPTIVE_MODE = str(st.secrets.get("ADAPTIVE_MODE", os.getenv("ADAPTIVE_MODE", ""))).strip().lower() in ("1", "true", "yes", "on")
+
+
 # ======================
 # HELPERS
 # ======================
@@ -37,24 +61,18 @@ def utcnow_iso():
 def session_path(session_id: str) -> Path:
     return SESSIONS_DIR / f"{session_id}.json"
 
-def save_session(payload: dict):
+def save_session(payload: dict, indent=2):
+    # атомарно: пишем во временный файл рядом и подменяем через os.replace,
+    # чтобы читатели (мастер-панель) никогда не видели наполовину записанный JSON
     sid = payload["meta"]["session_id"]
-    session_path(sid).write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
-
-def load_session(session_id: str):
-    p = session_path(session_id)
-    if not p.exists():
-        return None
-    return json.loads(p.read_text(encoding="utf-8"))
+    p = session_path(sid)
+    tmp = p.with_name(f".{sid}.{uuid.uuid4().hex}.tmp")
+    try:
+        tmp.write_text(json.dumps(payload, ensure_ascii=False, indent=indent), encoding="utf-8")
+        os.replace(tmp, p)
+    finally:
+        tmp.unlink(missing_ok=True)
 
-def list_sessions():
-    out = []
-    for p in sorted(SESSIONS_DIR.glob("*.json"), key=lambda x: x.stat().st_mtime, reverse=True):
-        try:
-            out.append(json.loads(p.read_text(encoding="utf-8")))
-        except Exception:
-            pass
-    return out
 
 
 # ======================
@@ -77,6 +95,58 @@ def safe_model_name(model: str) -> str:
         return DEFAULT_MODEL
     return m
 
+TIKTOKEN_ENCODING = "o200k_base"  # gpt-4o / gpt-4.1
+TIKTOKEN_URL = f"https://openaipublic.blob.core.windows.net/encodings/{TIKTOKEN_ENCODING}.tiktoken"
+
+
+def _tiktoken_cache_file():
+    """
+    Где tiktoken держит BPE-файл (повторяет tiktoken.load.read_file_cached:
+    TIKTOKEN_CACHE_DIR, затем DATA_GYM_CACHE_DIR, затем tmp/data-gym-cache;
+    пустой TIKTOKEN_CACHE_DIR = кэш выключен). None, если файла локально нет.
+    """
+    if "TIKTOKEN_CACHE_DIR" in os.environ:
+        cache_dir = os.environ["TIKTOKEN_CACHE_DIR"]
+    elif "DATA_GYM_CACHE_DIR" in os.environ:
+        cache_dir = os.environ["DATA_GYM_CACHE_DIR"]
+    else:
+        cache_dir = os.path.join(tempfile.gettempdir(), "data-gym-cache")
+    if not cache_dir:
+        return None  # без кэша tiktoken всегда качает файл из сети
+
+    cached = Path(cache_dir) / hashlib.sha1(TIKTOKEN_URL.encode()).hexdigest()
+    return cached if cached.exists() else None
+
+
+@st.cache_resource
+def _local_tiktoken_encoder():
+    """
+    tiktoken — опциональная зависимость (нет в requirements.txt).
+    Энкодер берём, только если BPE-файл уже лежит в локальном кэше
+    (иначе get_encoding полезет в сеть). Ищется один раз на процесс.
+    """
+    if _tiktoken_cache_file() is None:
+        return None
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(TIKTOKEN_ENCODING)
+    except Exception:
+        return None
+
+
+TIKTOKEN_ENC = _local_tiktoken_encoder()
+
+
+def count_tokens(text: str) -> int:
+    """
+    Офлайн-оценка токенов: локальный tiktoken, если есть,
+    иначе ~4 байта UTF-8 на токен (кириллица ≈ 2 символа на токен).
+    """
+    text = text or ""
+    if TIKTOKEN_ENC is not None:
+        return len(TIKTOKEN_ENC.encode(text))
+    return math.ceil(len(text.encode("utf-8")) / 4)
+
 
 # ======================
 # POTENTIALS / SPHERES
@@ -246,16 +316,20 @@ def init_state():
     st.session_state.setdefault("q_index", 0)
     st.session_state.setdefault("answers", {})
     st.session_state.setdefault("event_log", [])
+    st.session_state.setdefault("skipped", [])
+    st.session_state.setdefault("saved", False)
     st.session_state.setdefault("master_authed", False)
 
 def reset_diagnostic():
-    for k in ["q_index","answers","event_log"]:
+    for k in ["q_index","answers","event_log","skipped","saved"]:
         if k in st.session_state:
             del st.session_state[k]
     st.session_state["session_id"] = str(uuid.uuid4())
     st.session_state["q_index"] = 0
     st.session_state["answers"] = {}
     st.session_state["event_log"] = []
+    st.session_state["skipped"] = []
+    st.session_state["saved"] = False
 
 
 # ======================
@@ -398,6 +472,19 @@ def resolve_pot_questions_for_position(pos: int, chosen_sphere: str, column: str
     return qA, qB
 
 
+def chosen_sphere(answers: dict, pos: int):
+    """
+    Сфера позиции по ответам p{pos}_s1 и p{pos}_s2 (если ничья — берём s1).
+    None, если сферу ещё не ответили.
+    """
+    s1 = answers.get(f"p{pos}_s1")
+    s2 = answers.get(f"p{pos}_s2")
+    chosen = s1 if s1 else s2
+    if s1 and s2 and s1 != s2:
+        chosen = s1  # простой tie-break
+    return chosen or None
+
+
 def dynamic_question_plan(answers: dict):
     """
     Возвращает итоговый список вопросов с уже подставленными pot-вопросами.
@@ -412,13 +499,8 @@ def dynamic_question_plan(answers: dict):
             continue
 
         # placeholder -> подставляем 2 pot вопроса в зависимости от sphere
-        # sphere выбираем по ответам p{pos}_s1 и p{pos}_s2 (берём большинство; если ничья — берём s1)
         pos = q["position"]
-        s1 = answers.get(f"p{pos}_s1")
-        s2 = answers.get(f"p{pos}_s2")
-        chosen = s1 if s1 else s2
-        if s1 and s2 and s1 != s2:
-            chosen = s1  # простой tie-break
+        chosen = chosen_sphere(answers, pos)
 
         if not chosen:
             # пока сферу не ответили — в план не вставляем pot-вопросы
@@ -441,13 +523,14 @@ def dynamic_question_plan(answers: dict):
 # ======================
 # SCORING
 # ======================
-def score_all(answers: dict):
+def score_all(answers: dict, plan=None):
     pot_scores = {p: 0.0 for p in POTS}
     pos_scores = {str(i): {p: 0.0 for p in POTS} for i in range(1, 7)}
     col_scores = {c: {p: 0.0 for p in POTS} for c in COLUMNS}
 
     # динамический план нужен, чтобы мы знали position/column каждого реально заданного вопроса
-    plan = dynamic_question_plan(answers)
+    if plan is None:
+        plan = dynamic_question_plan(answers)
 
     # быстрый индекс id -> meta
     idx = {q["id"]: q for q in plan if q.get("id")}
@@ -480,8 +563,10 @@ def top_list(scores: dict, n=3):
     return [{"pot": p, "score": float(s)} for p, s in ranked[:n]]
 
 
-def build_payload(answers: dict, event_log: list, session_id: str):
-    scores, evidence, col_scores, pos_scores = score_all(answers)
+def build_payload(answers: dict, event_log: list, session_id: str, plan=None):
+    if plan is None:
+        plan = dynamic_question_plan(answers)
+    scores, evidence, col_scores, pos_scores = score_all(answers, plan)
     name, request, contact = current_meta(answers)
 
     ranked = sorted(scores.items(), key=lambda x: float(x[1]), reverse=True)
@@ -497,7 +582,7 @@ def build_payload(answers: dict, event_log: list, session_id: str):
             "name": name,
             "request": request,
             "contact": contact,
-            "question_count": len(dynamic_question_plan(answers)),
+            "question_count": len(plan),
             "answered_count": len(event_log),
         },
         "answers": answers,
@@ -509,6 +594,7 @@ def build_payload(answers: dict, event_log: list, session_id: str):
         "event_log": event_log,
         "ai_client_report": "",
         "ai_master_report": "",
+        "ai_usage": [],
     }
     return payload
 
@@ -539,32 +625,211 @@ def build_insight_table(payload: dict) -> dict:
 
 
 # ======================
-# REPORTS
+# ADAPTIVE (пропуск лишних вопросов)
+# Пропускаем sphere-вопрос, если он уже не может поменять сферу позиции (chosen_sphere).
+# При текущем tie-break это ровно p{pos}_s2 после ответа на s1: s2 и так не влияет
+# на scoring. pot-вопросы не пропускаем — при 2 вопросах на позицию ни один pot-ответ
+# не бывает заранее решён, а пропуск менял бы общие суммы/top3.
 # ======================
-def call_openai_for_reports(client, model: str, payload: dict):
-    table = build_insight_table(payload)
-    sys = (
-        "Ты — эксперт по диагностике потенциалов NEO.\n"
-        "Сгенерируй 2 отчёта:\n"
-        "A) CLIENT: 12–18 строк. Назови потенциалы (можно), пройдись по колонкам "
-        "(восприятие/мотивация/инструмент) и по 1–2 рискам. "
-        "Скажи, что отчёт предварительный и предложи консультацию.\n"
-        "B) MASTER: структурно: топ-5, колонки, позиции, конфликты, что уточнить, "
-        "и как вести к реализации/монетизации.\n"
-        "Пиши по-русски, конкретно, без воды."
-    )
+# оценка: сколько перезапусков скрипта стоит один вопрос — клик «Далее» + st.rerun()
+RERUNS_PER_QUESTION = 2
+
+
+def _sphere_skip_table() -> dict:
+    """
+    (номер sphere-вопроса, ответ на другой sphere-вопрос) -> можно ли пропустить.
+    Считаем один раз перебором через chosen_sphere, чтобы не дублировать tie-break.
+    """
+    values = [None] + list(SPHERE_MAP)
+    table = {}
+    for qn, other in ((1, 2), (2, 1)):
+        for other_ans in values:
+            base = {f"p1_s{other}": other_ans} if other_ans else {}
+            before = chosen_sphere(base, 1)
+            table[(qn, other_ans)] = before is not None and all(
+                chosen_sphere({**base, f"p1_s{qn}": v}, 1) == before for v in SPHERE_MAP
+            )
+    return table
+
+
+SPHERE_SKIP = _sphere_skip_table()
+# номера sphere-вопросов, которые пропускаются при любом ответе на предыдущий (сейчас {2})
+SPHERE_ALWAYS_SKIPPED = {qn for qn in (1, 2) if all(SPHERE_SKIP[(qn, v)] for v in SPHERE_MAP)}
 
-    resp = client.responses.create(
-        model=model,
-        input=[
-            {"role": "system", "content": sys},
-            {"role": "user", "content": json.dumps(table, ensure_ascii=False)}
-        ],
-        response_format={"type": "json_object"},
+
+def can_skip_question(q: dict, answers: dict) -> bool:
+    if q["stage"] != "sphere":
+        return False
+    qn = int(q["id"][-1])
+    return SPHERE_SKIP[(qn, answers.get(f"p{q['position']}_s{3 - qn}"))]
+
+
+def next_question_index(start: int, answers: dict, skipped: list) -> int:
+    """
+    Первый индекс >= start, который нельзя пропустить; пропущенные id дописывает в skipped.
+    """
+    plan = dynamic_question_plan(answers)
+    i = start
+    while i < len(plan) and can_skip_question(plan[i], answers):
+        skipped.append(plan[i]["id"])
+        i += 1
+    return i
+
+
+def progress(plan: list, q_index: int, skipped: list):
+    """
+    (номер текущего вопроса, всего вопросов) для подписи «вопрос X из N»
+    без пропущенных и заведомо пропускаемых вопросов.
+    """
+    if not ADAPTIVE_MODE:
+        return min(q_index + 1, len(plan)), len(plan)
+    will_skip = sum(
+        1 for q in plan
+        if q["stage"] == "sphere" and int(q["id"][-1]) in SPHERE_ALWAYS_SKIPPED
     )
+    total = len(plan) - will_skip
+    return min(q_index - len(skipped) + 1, total), total
+
+
+def adaptive_meta(skipped: list) -> dict:
+    return {
+        "adaptive": ADAPTIVE_MODE,
+        "skipped_questions": list(skipped),
+        "saved_questions": len(skipped),
+        # не замер, а оценка: RERUNS_PER_QUESTION на каждый пропущенный вопрос
+        "saved_reruns_est": len(skipped) * RERUNS_PER_QUESTION,
+    }
+
+
+# ======================
+# PROMPT (компактная таблица для модели)
+# ======================
+COL_SHORT = {"perception": "cp", "motivation": "cm", "instrument": "ci"}
+
+# что выкидываем первым, если не влезаем в бюджет:
+# колонки (они = сумма позиций 1+4 / 2+5 / 3+6), потом второй слой позиций,
+# потом текст запроса, потом первый слой. Общий счёт "t" не выкидываем никогда.
+PROMPT_DROP_ORDER = ["cp", "cm", "ci", "p6", "p5", "p4", "rq", "p3", "p2", "p1"]
+
+REPORT_SYSTEM_PROMPT = (
+    "Ты — эксперт по диагностике потенциалов NEO.\n"
+    "Данные (JSON): t — общий счёт потенциалов; cp/cm/ci — колонки "
+    "восприятие/мотивация/инструмент; p1..p6 — позиции; rq — запрос клиента. "
+    "Указаны только ненулевые потенциалы, часть разделов может отсутствовать.\n"
+    "Сгенерируй 2 отчёта:\n"
+    "A) CLIENT: 12–18 строк. Назови потенциалы (можно), пройдись по колонкам "
+    "(восприятие/мотивация/инструмент) и по 1–2 рискам. "
+    "Скажи, что отчёт предварительный и предложи консультацию.\n"
+    "B) MASTER: структурно: топ-5, колонки, позиции, конфликты, что уточнить, "
+    "и как вести к реализации/монетизации.\n"
+    "Пиши по-русски, конкретно, без воды."
+)
+
+
+def _nonzero(scores: dict) -> dict:
+    ranked = sorted(scores.items(), key=lambda x: float(x[1]), reverse=True)
+    out = {}
+    for p, s in ranked:
+        s = float(s)
+        if s:
+            out[p] = int(s) if s.is_integer() else s
+    return out
+
+
+def build_prompt_table(payload: dict) -> dict:
+    """
+    Компактная версия build_insight_table для модели:
+    короткие ключи, только ненулевые потенциалы, без meta (имя/контакт/счётчики).
+    """
+    col_scores = payload.get("col_scores", {})
+    pos_scores = payload.get("pos_scores", {})
+    answers = payload.get("answers", {})
+
+    table = {"t": _nonzero(payload.get("scores", {}))}
+    for c in COLUMNS:
+        table[COL_SHORT[c]] = _nonzero(col_scores.get(c, {}))
+    for i in range(1, 7):
+        table[f"p{i}"] = _nonzero(pos_scores.get(str(i), {}))
+    table["rq"] = str(answers.get("intake.request", "") or "").strip()
+
+    return {k: v for k, v in table.items() if v}
+
+
+def encode_prompt_table(table: dict) -> str:
+    return json.dumps(table, ensure_ascii=False, separators=(",", ":"))
+
+
+def fit_prompt_to_budget(table: dict, budget: int):
+    """
+    Выкидывает разделы по PROMPT_DROP_ORDER, пока system + данные не влезут в budget.
+    Возвращает (текст данных, оценка токенов входа, список выкинутых разделов).
+    """
+    table = dict(table)
+    base = count_tokens(REPORT_SYSTEM_PROMPT)
+    text = encode_prompt_table(table)
+    tokens = base + count_tokens(text)
+    dropped = []
+
+    for key in PROMPT_DROP_ORDER:
+        if not budget or tokens <= budget:
+            break
+        if key not in table:
+            continue
+        del table[key]
+        dropped.append(key)
+        text = encode_prompt_table(table)
+        tokens = base + count_tokens(text)
+
+    return text, tokens, dropped
+
+
+# ======================
+# REPORTS
+# ======================
+def call_openai_for_reports(client, model: str, payload: dict, usage_log: list, budget: int = PROMPT_TOKEN_BUDGET):
+    """
+    usage_log: сюда дописывается запись о вызове (токены, latency, ошибка) —
+    в том числе когда вызов или разбор ответа упал.
+    """
+    data_text, est_tokens, dropped = fit_prompt_to_budget(build_prompt_table(payload), budget)
+
+    usage_rec = {
+        "timestamp": utcnow_iso(),
+        "model": model,
+        "budget": budget,
+        "input_tokens_est": est_tokens,
+        "input_tokens": None,
+        "output_tokens": None,
+        "latency_ms": None,
+        "dropped_sections": dropped,
+        "error": "",
+    }
+    t0 = time.perf_counter()
+    try:
+        resp = client.responses.create(
+            model=model,
+            input=[
+                {"role": "system", "content": REPORT_SYSTEM_PROMPT},
+                {"role": "user", "content": data_text}
+            ],
+            response_format={"type": "json_object"},
+        )
+        usage_rec["latency_ms"] = round((time.perf_counter() - t0) * 1000)
+
+        usage = getattr(resp, "usage", None)
+        usage_rec["input_tokens"] = getattr(usage, "input_tokens", None)
+        usage_rec["output_tokens"] = getattr(usage, "output_tokens", None)
+
+        txt = resp.output_text
+        data = json.loads(txt) if txt else {}
+    except Exception as e:
+        usage_rec["error"] = str(e)
+        raise
+    finally:
+        if usage_rec["latency_ms"] is None:
+            usage_rec["latency_ms"] = round((time.perf_counter() - t0) * 1000)
+        usage_log.append(usage_rec)
 
-    txt = resp.output_text
-    data = json.loads(txt) if txt else {}
     client_report = data.get("client_report", "")
     master_report = data.get("master_report", "")
     return client_report, master_report
@@ -580,7 +845,8 @@ def render_client_flow():
     colA, colB = st.columns([3, 1])
     with colA:
         stage = plan[min(st.session_state["q_index"], total - 1)]["stage"] if total else "—"
-        st.caption(f"Ход: вопрос {min(st.session_state['q_index']+1, total)} из {total} | этап: {stage}")
+        cur, shown_total = progress(plan, st.session_state["q_index"], st.session_state["skipped"])
+        st.caption(f"Ход: вопрос {cur} из {shown_total} | этап: {stage}")
 
     with colB:
         if st.button("🔄 Сбросить", use_container_width=True):
@@ -608,6 +874,10 @@ def render_client_flow():
                         "answer": ans
                     })
                     st.session_state["q_index"] += 1
+                    if ADAPTIVE_MODE:
+                        st.session_state["q_index"] = next_question_index(
+                            st.session_state["q_index"], st.session_state["answers"], st.session_state["skipped"]
+                        )
 
                     # пересчитаем план (после sphere ответы появятся pot вопросы)
                     st.rerun()
@@ -615,22 +885,131 @@ def render_client_flow():
         with c2:
             if st.button("Завершить сейчас", use_container_width=True):
                 payload = build_payload(st.session_state["answers"], st.session_state["event_log"], st.session_state["session_id"])
+                payload["meta"].update(adaptive_meta(st.session_state["skipped"]))
                 save_session(payload)
+                st.session_state["saved"] = True
                 st.session_state["q_index"] = total
                 st.rerun()
 
     else:
         payload = build_payload(st.session_state["answers"], st.session_state["event_log"], st.session_state["session_id"])
-        try:
-            save_session(payload)
-        except Exception:
-            pass
+        payload["meta"].update(adaptive_meta(st.session_state["skipped"]))
+        # сохраняем один раз: иначе каждый rerun (в т.ч. из мастер-панели) перетирал бы
+        # файл свежим payload и терял ai_usage / AI-отчёты
+        if not st.session_state["saved"]:
+            try:
+                save_session(payload)
+                st.session_state["saved"] = True
+            except Exception:
+                pass
 
         st.success("Диагностика завершена ✅")
+        if ADAPTIVE_MODE and st.session_state["skipped"]:
+            st.caption(f"Пропущено вопросов: {len(st.session_state['skipped'])}")
         st.markdown("### Предварительный результат (технический)")
         st.json(build_insight_table(payload))
 
 
+# ======================
+# SESSION CACHE (мастер-панель)
+# Живёт между rerun-ами (st.cache_resource). Запись валидна, пока у файла
+# те же mtime_ns и размер; payload / таблица инсайтов / байты для скачивания
+# считаются один раз на версию файла. LRU на SESSION_CACHE_SIZE сессий.
+# ======================
+SESSION_CACHE_SIZE = 32
+
+
+@st.cache_resource
+def _session_cache():
+    return {"lock": threading.Lock(), "lru": OrderedDict(), "metas": {}}
+
+
+def _file_key(p: Path):
+    try:
+        stt = p.stat()
+    except FileNotFoundError:
+        return None
+    return (stt.st_mtime_ns, stt.st_size)
+
+
+def cached_session(session_id: str):
+    """
+    Запись кэша {"key", "raw", "payload", "insight", "download"} или None, если файла нет.
+    payload из кэша не мутировать — он общий для всех rerun-ов.
+    """
+    p = session_path(session_id)
+    key = _file_key(p)
+    if key is None:
+        return None
+
+    cache = _session_cache()
+    with cache["lock"]:
+        entry = cache["lru"].get(session_id)
+        if entry and entry["key"] == key:
+            cache["lru"].move_to_end(session_id)
+            return entry
+
+    raw = p.read_bytes()
+    entry = {"key": key, "raw": raw, "payload": json.loads(raw), "insight": None, "download": None}
+
+    with cache["lock"]:
+        cache["lru"][session_id] = entry
+        cache["lru"].move_to_end(session_id)
+        while len(cache["lru"]) > SESSION_CACHE_SIZE:
+            cache["lru"].popitem(last=False)
+    return entry
+
+
+def cached_download(entry: dict) -> bytes:
+    """
+    JSON для кнопки скачивания в прежнем виде (indent=2). Файлы из save_session уже такие —
+    отдаём байты как есть; компактные (bulk ingest) форматируем один раз на версию файла.
+    """
+    if entry["download"] is None:
+        raw = entry["raw"]
+        if raw.startswith(b"{\n"):
+            entry["download"] = raw
+        else:
+            entry["download"] = json.dumps(entry["payload"], ensure_ascii=False, indent=2).encode("utf-8")
+    return entry["download"]
+
+
+def cached_insight_table(entry: dict) -> dict:
+    if entry["insight"] is None:
+        entry["insight"] = build_insight_table(entry["payload"])
+    return entry["insight"]
+
+
+def list_session_metas():
+    """
+    meta всех сессий (новые сверху) без повторного чтения неизменившихся файлов.
+    """
+    cache = _session_cache()
+    keyed = []
+    for p in SESSIONS_DIR.glob("*.json"):
+        key = _file_key(p)
+        if key is not None:
+            keyed.append((key, p))
+    keyed.sort(key=lambda x: x[0][0], reverse=True)
+
+    out, seen = [], set()
+    with cache["lock"]:
+        metas = cache["metas"]
+        for key, p in keyed:
+            seen.add(p.name)
+            hit = metas.get(p.name)
+            if not hit or hit[0] != key:
+                try:
+                    meta = json.loads(p.read_bytes()).get("meta", {})
+                except Exception:
+                    continue
+                hit = metas[p.name] = (key, meta)
+            out.append(hit[1])
+        for name in set(metas) - seen:
+            del metas[name]
+    return out
+
+
 # ======================
 # MASTER PANEL
 # ======================
@@ -650,26 +1029,27 @@ def render_master_panel():
                 st.error("Неверный пароль")
         st.stop()
 
-    sessions = list_sessions()
-    if not sessions:
+    metas = list_session_metas()
+    if not metas:
         st.info("Пока нет сохранённых сессий.")
         st.stop()
 
     labels, ids = [], []
-    for s in sessions:
-        sid = s.get("meta", {}).get("session_id", "")
-        name = s.get("meta", {}).get("name", "—")
-        req = s.get("meta", {}).get("request", "—")
-        ts = s.get("meta", {}).get("timestamp", "—")
+    for m in metas:
+        sid = m.get("session_id", "")
+        name = m.get("name", "—")
+        req = m.get("request", "—")
+        ts = m.get("timestamp", "—")
         labels.append(f"{name} | {req} | {ts} | {sid[:8]}")
         ids.append(sid)
 
     pick = st.selectbox("Сессии:", labels, index=0, key="master_pick")
     chosen_id = ids[labels.index(pick)]
-    payload = load_session(chosen_id)
-    if not payload:
+    entry = cached_session(chosen_id)
+    if not entry:
         st.error("Не удалось загрузить сессию.")
         st.stop()
+    payload = entry["payload"]
 
     meta = payload.get("meta", {})
     st.markdown(
@@ -678,17 +1058,24 @@ def render_master_panel():
         f"**Запрос:** {meta.get('request','—')}\n\n"
         f"**Вопросов:** {meta.get('question_count','—')} | **Ответов:** {meta.get('answered_count','—')}\n"
     )
+    if meta.get("saved_questions"):
+        st.caption(
+            f"Адаптивный режим: пропущено {meta['saved_questions']} вопросов "
+            f"(оценка ≈{meta.get('saved_reruns_est', 0)} перезапусков)"
+        )
 
+    # байты из кэша: без повторной сериализации на каждый rerun
     st.download_button(
         "⬇️ Скачать JSON",
-        data=json.dumps(payload, ensure_ascii=False, indent=2).encode("utf-8"),
+        data=cached_download(entry),
         file_name=f"session_{chosen_id[:8]}.json",
         mime="application/json",
         use_container_width=True
     )
 
-    with st.expander("📌 Таблица инсайтов (для мастера)"):
-        st.json(build_insight_table(payload))
+    # содержимое expander-а рендерится всегда, поэтому большой st.json — только по флажку
+    if st.toggle("📌 Таблица инсайтов (для мастера)", key="master_show_insight"):
+        st.json(cached_insight_table(entry), expanded=False)
 
     st.markdown("---")
     st.subheader("🧠 AI-отчёты")
@@ -700,21 +1087,40 @@ def render_master_panel():
         if not client:
             st.error("Нет OPENAI_API_KEY в secrets/env")
         else:
+            usage_log = []
             try:
                 model = safe_model_name(model_in)
-                cr, mr = call_openai_for_reports(client, model, payload)
+                cr, mr = call_openai_for_reports(client, model, payload, usage_log)
 
                 st.markdown("### Клиентский отчёт")
                 st.write(cr)
                 st.markdown("### Мастерский отчёт")
                 st.write(mr)
 
-                payload["ai_client_report"] = cr
-                payload["ai_master_report"] = mr
-                save_session(payload)
-                st.success("Готово ✅ сохранено в сессии.")
+                # payload общий с кэшем — собираем новый, а не мутируем
+                payload = {**payload, "ai_client_report": cr, "ai_master_report": mr}
             except Exception as e:
                 st.error(f"Ошибка генерации: {e}")
+                cr = mr = None
+
+            # учёт токенов/latency сохраняем и для упавших вызовов
+            if usage_log:
+                payload = {**payload, "ai_usage": payload.get("ai_usage", []) + usage_log}
+                try:
+                    save_session(payload)
+                    if cr is not None:
+                        st.success("Готово ✅ сохранено в сессии.")
+                except Exception as e:
+                    st.error(f"Ошибка сохранения: {e}")
+
+    if payload.get("ai_usage"):
+        u = payload["ai_usage"][-1]
+        st.caption(
+            f"Последний вызов: {u.get('model','—')} | вход ≈{u.get('input_tokens_est','—')} "
+            f"(факт {u.get('input_tokens','—')}) | выход {u.get('output_tokens','—')} | "
+            f"{u.get('latency_ms','—')} мс | вызовов: {len(payload['ai_usage'])}"
+            + (f" | ошибка: {u['error']}" if u.get("error") else "")
+        )
 
     if payload.get("ai_client_report") or payload.get("ai_master_report"):
         with st.expander("🗂️ Показать сохранённые AI-отчёты"):
@@ -726,17 +1132,269 @@ def render_master_panel():
                 st.write(payload["ai_master_report"])
 
 
+# ======================
+# BULK INGEST (NDJSON)
+# python app.py ingest sessions.ndjson [--rejects rejects.ndjson] [--overwrite]
+# одна строка = {"session_id"?: str, "timestamp"?: str, "source"?: str, "answers": {...}}
+# ======================
+INGEST_BATCH_SIZE = 500
+INGEST_WRITERS = 8
+SESSION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+_QUESTION_BANK = None
+_OPTION_IDS = None
+# куски плана для plan_from_bank: intake, sphere-вопросы позиции, pot-вопросы (позиция, сфера)
+_PLAN_INTAKE = None
+_PLAN_SPHERE = None
+_PLAN_POTS = None
+
+
+def question_bank() -> dict:
+    """
+    id -> вопрос для всех вопросов, которые может вернуть dynamic_question_plan
+    (pot-вопросы — по всем трём сферам). Строится один раз.
+    """
+    global _QUESTION_BANK, _OPTION_IDS, _PLAN_INTAKE, _PLAN_SPHERE, _PLAN_POTS
+    if _QUESTION_BANK is None:
+        bank, intake, spheres, pots = {}, [], {}, {}
+        for q in build_dynamic_plan():
+            pos = q["position"]
+            if q.get("type") == "placeholder":
+                if q["id"].endswith("potA"):
+                    for sphere in SPHERE_MAP:
+                        pots[(pos, sphere)] = list(resolve_pot_questions_for_position(pos, sphere, q["column"]))
+                        for pq in pots[(pos, sphere)]:
+                            bank[pq["id"]] = pq
+            else:
+                bank[q["id"]] = q
+                (intake if pos == 0 else spheres.setdefault(pos, [])).append(q)
+        _OPTION_IDS = {
+            qid: frozenset(o["id"] for o in q["options"])
+            for qid, q in bank.items() if q["type"] == "single"
+        }
+        _PLAN_INTAKE, _PLAN_SPHERE, _PLAN_POTS = intake, spheres, pots
+        _QUESTION_BANK = bank
+    return _QUESTION_BANK
+
+
+def plan_from_bank(answers: dict) -> list:
+    """
+    То же, что dynamic_question_plan(answers), но из готовых вопросов банка —
+    без пересборки ~40 словарей на каждую запись. answers должны пройти validate_answers.
+    """
+    question_bank()
+    plan = list(_PLAN_INTAKE)
+    for pos in range(1, 7):
+        plan += _PLAN_SPHERE[pos]
+        chosen = chosen_sphere(answers, pos)
+        if chosen:
+            plan += _PLAN_POTS[(pos, chosen)]
+    return plan
+
+
+def validate_answers(answers) -> str:
+    """
+    Проверяет ответы по банку вопросов. Возвращает текст ошибки или "" если всё ок.
+    pot-ответ валиден только в сфере, которую выбрал бы dynamic_question_plan.
+    """
+    if not isinstance(answers, dict) or not answers:
+        return "answers: ожидается непустой объект"
+
+    bank = question_bank()
+    for qid, ans in answers.items():
+        q = bank.get(qid)
+        if not q:
+            return f"{qid}: неизвестный вопрос"
+        if q["type"] == "text":
+            if not isinstance(ans, str) or not ans.strip():
+                return f"{qid}: ожидается непустой текст"
+        elif ans not in _OPTION_IDS[qid]:
+            return f"{qid}: недопустимый вариант {ans!r}"
+
+    for qid in answers:
+        q = bank[qid]
+        if q["stage"] == "potential" and q["sphere"] != chosen_sphere(answers, q["position"]):
+            return f"{qid}: вопрос не из выбранной сферы позиции {q['position']}"
+    return ""
+
+
+def ingest_record(rec) -> dict:
+    """
+    Валидирует одну запись и собирает payload как build_payload.
+    Бросает ValueError на битую запись.
+    """
+    if not isinstance(rec, dict):
+        raise ValueError("запись: ожидается объект")
+
+    answers = rec.get("answers")
+    err = validate_answers(answers)
+    if err:
+        raise ValueError(err)
+
+    sid = str(rec.get("session_id") or uuid.uuid4())
+    if not SESSION_ID_RE.match(sid):
+        raise ValueError(f"session_id: недопустимое значение {sid!r}")
+
+    ts = str(rec.get("timestamp") or utcnow_iso())
+    plan = plan_from_bank(answers)
+    # порядок event_log — как в плане, чтобы сессия выглядела как пройденная в UI
+    event_log = [
+        {
+            "timestamp": ts,
+            "question_id": q["id"],
+            "question_text": q["text"],
+            "answer_type": q["type"],
+            "answer": answers[q["id"]],
+        }
+        for q in plan if q["id"] in answers
+    ]
+    # на случай, если план и банк когда-нибудь разойдутся
+    if len(event_log) != len(answers):
+        missing = sorted(set(answers) - {e["question_id"] for e in event_log})
+        raise ValueError(f"вопросы вне плана: {', '.join(missing)}")
+
+    payload = build_payload(answers, event_log, sid, plan)
+    payload["meta"]["timestamp"] = ts
+    payload["meta"]["source"] = str(rec.get("source") or "ingest")
+    return payload
+
+
+def _save_compact(payload: dict):
+    # без indent json идёт через C-энкодер — в разы быстрее; cached_session читает оба варианта,
+    # а для скачивания cached_download вернёт indent=2
+    save_session(payload, indent=None)
+
+
+def _flush_batch(pool, batch: dict, pending: dict, stats: dict, reject) -> dict:
+    """
+    Дожидается записи предыдущей пачки и отправляет текущую в фон:
+    разбор следующей пачки идёт параллельно с диском, в памяти максимум 2 пачки.
+    Пачка — session_id -> (номер строки, payload, заменяет ли существующий файл),
+    так что один файл в пачке пишется один раз.
+    ok считаем только после успешной записи; ошибки записи уходят в rejects.
+    """
+    for sid, (n, replaces, f) in pending.items():
+        try:
+            f.result()
+        except OSError as e:
+            reject(n, "", f"запись {sid!r}: {e}", counter="failed")
+            continue
+        stats["ok"] += 1
+        if replaces:
+            stats["replaced"] += 1
+    return {
+        sid: (n, replaces, pool.submit(_save_compact, payload))
+        for sid, (n, payload, replaces) in batch.items()
+    }
+
+
+def ingest_ndjson(lines, rejects, batch_size: int = INGEST_BATCH_SIZE, overwrite: bool = False) -> dict:
+    """
+    Потоково читает NDJSON (итератор строк bytes или str), пишет сессии пачками по batch_size.
+    Битые строки (не UTF-8, не JSON, слишком глубокая вложенность, не проходят валидацию)
+    уходят в rejects (файловый объект) как {"line", "error", "raw"}.
+    Повтор session_id (в потоке или уже на диске) — тоже в rejects, если не overwrite;
+    с overwrite побеждает последняя запись.
+
+    stats: ok — записано файлов; replaced — из них поверх уже существующего файла;
+    overwritten — записи, вытесненные более поздней с тем же id в той же пачке (не писались);
+    failed — ошибки записи на диск.
+    Память ограничена двумя пачками (одна разбирается, одна пишется).
+    """
+    stats = {"ok": 0, "rejected": 0, "skipped_blank": 0, "overwritten": 0, "replaced": 0, "failed": 0}
+    batch, pending = {}, {}
+
+    def reject(n, raw, err, counter="rejected"):
+        rejects.write(json.dumps({"line": n, "error": err, "raw": raw}, ensure_ascii=False) + "\n")
+        stats[counter] += 1
+
+    with ThreadPoolExecutor(max_workers=INGEST_WRITERS) as pool:
+        try:
+            for n, line in enumerate(lines, start=1):
+                try:
+                    raw = line.decode("utf-8") if isinstance(line, bytes) else line
+                    raw = raw.strip()
+                    if not raw:
+                        stats["skipped_blank"] += 1
+                        continue
+                    payload = ingest_record(json.loads(raw))
+                except (ValueError, TypeError, RecursionError) as e:
+                    # UnicodeDecodeError и JSONDecodeError — тоже ValueError
+                    if isinstance(line, bytes):
+                        line = line.decode("utf-8", errors="replace")
+                    reject(n, line.strip(), f"{type(e).__name__}: {e}")
+                    continue
+
+                sid = payload["meta"]["session_id"]
+                # более ранние пачки уже на диске: _flush_batch дожидается их перед отправкой следующей
+                exists = sid in pending or session_path(sid).exists()
+                if sid in batch:
+                    if not overwrite:
+                        reject(n, raw, f"session_id: {sid!r} уже существует (используй --overwrite)")
+                        continue
+                    stats["overwritten"] += 1
+                    exists = batch[sid][2]
+                elif exists and not overwrite:
+                    reject(n, raw, f"session_id: {sid!r} уже существует (используй --overwrite)")
+                    continue
+
+                batch[sid] = (n, payload, exists)
+                if len(batch) >= batch_size:
+                    pending = _flush_batch(pool, batch, pending, stats, reject)
+                    batch = {}
+        finally:
+            # что успели разобрать — дописываем даже при неожиданной ошибке чтения
+            pending = _flush_batch(pool, batch, pending, stats, reject)
+            _flush_batch(pool, {}, pending, stats, reject)
+
+    return stats
+
+
+def ingest_main(argv: list) -> int:
+    parser = argparse.ArgumentParser(prog="app.py ingest", description="Bulk-импорт сессий из NDJSON")
+    parser.add_argument("src", help="NDJSON-файл или '-' для stdin")
+    parser.add_argument("--rejects", help="куда писать битые строки (по умолчанию <src>.rejects.ndjson)")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    parser.add_argument("--overwrite", action="store_true", help="перезаписывать существующие session_id")
+    args = parser.parse_args(argv)
+
+    rejects_path = args.rejects or ("rejects.ndjson" if args.src == "-" else f"{args.src}.rejects.ndjson")
+    t0 = time.perf_counter()
+
+    # читаем байты: декодирование идёт построчно внутри ingest_ndjson,
+    # так что битый UTF-8 уходит в rejects, а не роняет весь прогон
+    with open(rejects_path, "w", encoding="utf-8") as rejects:
+        if args.src == "-":
+            stats = ingest_ndjson(sys.stdin.buffer, rejects, args.batch_size, args.overwrite)
+        else:
+            with open(args.src, "rb") as src:
+                stats = ingest_ndjson(src, rejects, args.batch_size, args.overwrite)
+
+    dt = time.perf_counter() - t0
+    rate = stats["ok"] / dt if dt else 0.0
+    print(
+        " ".join(f"{k}={v}" for k, v in stats.items())
+        + f" time={dt:.2f}s rate={rate:.0f}/s rejects={rejects_path}"
+    )
+    return 1 if stats["failed"] else 0
+
+
 # ======================
 # MAIN
+# (streamlit run тоже исполняет скрипт как __main__; import app из тестов UI не трогает)
 # ======================
-init_state()
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["ingest"]:
+        sys.exit(ingest_main(sys.argv[2:]))
+
+    init_state()
 
-st.title("💠 NEO Диагностика потенциалов (v8)")
+    st.title("💠 NEO Диагностика потенциалов (v8)")
 
-tab1, tab2 = st.tabs(["🧑‍💼 Клиент", "🛠️ Мастер"])
+    tab1, tab2 = st.tabs(["🧑‍💼 Клиент", "🛠️ Мастер"])
 
-with tab1:
-    render_client_flow()
+    with tab1:
+        render_client_flow()
 
-with tab2:
-    render_master_panel()
\ No newline at end of file
+    with tab2:
+        render_master_panel()
\ No newline at end of file
@@ -0,0 +1,30 @@
+# tests/conftest.py
+# Тестируем чистую логику app.py без Streamlit: подменяем модуль минимальной заглушкой.
+# UI в app.py запускается только под __main__, поэтому import app ничего не рендерит.
+import sys
+import types
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+_st = types.ModuleType("streamlit")
+_st.secrets = {}
+_st.session_state = {}
+_st.set_page_config = lambda **kwargs: None
+_st.cache_resource = lambda f: __import__("functools").lru_cache(maxsize=None)(f)
+sys.modules["streamlit"] = _st
+
+
+@pytest.fixture
+def sessions_dir(tmp_path, monkeypatch):
+    """Пустой SESSIONS_DIR во временной папке и чистый кэш мастер-панели."""
+    import app
+
+    monkeypatch.setattr(app, "SESSIONS_DIR", tmp_path)
+    cache = app._session_cache()
+    cache["lru"].clear()
+    cache["metas"].clear()
+    return tmp_path
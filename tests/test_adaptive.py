@@ -0,0 +1,53 @@
+# tests/test_adaptive.py
+import random
+
+import app
+
+
+def test_sphere_skip_table():
+    # s1 решает сферу сам по себе, s2 — только пока s1 не отвечен
+    for sphere in app.SPHERE_MAP:
+        assert app.SPHERE_SKIP[(2, sphere)] is True
+        assert app.SPHERE_SKIP[(1, sphere)] is False
+    assert app.SPHERE_SKIP[(1, None)] is False
+    assert app.SPHERE_SKIP[(2, None)] is False
+    assert app.SPHERE_ALWAYS_SKIPPED == {2}
+
+
+def walk(rng, monkeypatch, adaptive=True):
+    """Проходит анкету случайными ответами; возвращает (answers, skipped, подписи прогресса)."""
+    monkeypatch.setattr(app, "ADAPTIVE_MODE", adaptive)
+    answers, skipped, i, shown = {}, [], 0, []
+    while True:
+        plan = app.dynamic_question_plan(answers)
+        if i >= len(plan):
+            break
+        shown.append(app.progress(plan, i, skipped))
+        q = plan[i]
+        answers[q["id"]] = "x" if q["type"] == "text" else rng.choice(q["options"])["id"]
+        i = app.next_question_index(i + 1, answers, skipped) if adaptive else i + 1
+    return answers, skipped, shown
+
+
+def test_flow_skips_only_second_sphere_questions(monkeypatch):
+    rng = random.Random(0)
+    for _ in range(100):
+        answers, skipped, _ = walk(rng, monkeypatch)
+        assert skipped == [f"p{pos}_s2" for pos in range(1, 7)]
+        assert sum(app.score_all(answers)[0].values()) == 12  # все pot-ответы на месте
+
+
+def test_progress_counts_only_asked_questions(monkeypatch):
+    _, _, shown = walk(random.Random(1), monkeypatch)
+    assert [cur for cur, _ in shown] == list(range(1, 22))
+    assert shown[-1] == (21, 21)
+
+    _, _, shown = walk(random.Random(1), monkeypatch, adaptive=False)
+    assert [cur for cur, _ in shown] == list(range(1, 28))
+    assert shown[-1] == (27, 27)
+
+
+def test_adaptive_meta():
+    meta = app.adaptive_meta(["p1_s2", "p2_s2"])
+    assert meta["saved_questions"] == 2
+    assert meta["saved_reruns_est"] == 2 * app.RERUNS_PER_QUESTION
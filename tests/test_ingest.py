@@ -0,0 +1,141 @@
+# tests/test_ingest.py
+import io
+import json
+import random
+
+import pytest
+
+import app
+
+
+def random_answers(rng, pot_count=2):
+    answers = {"intake.name": "N", "intake.request": "R", "intake.contact": "c"}
+    for pos in range(1, 7):
+        s1 = rng.choice(list(app.SPHERE_MAP))
+        answers[f"p{pos}_s1"] = s1
+        answers[f"p{pos}_s2"] = rng.choice(list(app.SPHERE_MAP))
+        for qn in range(1, pot_count + 1):
+            answers[f"p{pos}_p{qn}_{s1}"] = rng.choice(app.SPHERE_MAP[s1])
+    return answers
+
+
+def ndjson(*records):
+    return io.StringIO("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records))
+
+
+@pytest.mark.parametrize("answers, error", [
+    (None, "answers"),
+    ({}, "answers"),
+    ({"p9_s1": "matter"}, "неизвестный вопрос"),
+    ({"intake.name": "   "}, "непустой текст"),
+    ({"intake.name": 5}, "непустой текст"),
+    ({"p1_s1": "money"}, "недопустимый вариант"),
+    ({"p1_s1": "matter", "p1_p1_matter": "Рубин"}, "недопустимый вариант"),
+    ({"p1_s1": "emotions", "p1_p1_matter": "Янтарь"}, "не из выбранной сферы"),
+    ({"p1_p1_matter": "Янтарь"}, "не из выбранной сферы"),
+])
+def test_validate_answers_rejects(answers, error):
+    assert error in app.validate_answers(answers)
+
+
+def test_validate_answers_accepts_partial_session():
+    assert app.validate_answers({"intake.name": "N", "p1_s1": "meanings", "p1_p1_meanings": "Сапфир"}) == ""
+
+
+def test_plan_from_bank_matches_dynamic_plan():
+    rng = random.Random(0)
+    for _ in range(200):
+        answers = random_answers(rng, pot_count=rng.randint(0, 2))
+        for pos in rng.sample(range(1, 7), 2):  # часть позиций без ответа на сферу
+            for qid in [k for k in answers if k.startswith(f"p{pos}_")]:
+                del answers[qid]
+        expected = [q["id"] for q in app.dynamic_question_plan(answers)]
+        assert [q["id"] for q in app.plan_from_bank(answers)] == expected
+
+
+def test_ingest_scores_like_build_payload(sessions_dir):
+    answers = random_answers(random.Random(1))
+    stats = app.ingest_ndjson(ndjson({"session_id": "a1", "answers": answers}), io.StringIO())
+    assert stats["ok"] == 1
+
+    saved = json.loads((sessions_dir / "a1.json").read_text(encoding="utf-8"))
+    expected = app.build_payload(answers, saved["event_log"], "a1")
+    for key in ("scores", "col_scores", "pos_scores", "top3", "top6"):
+        assert saved[key] == expected[key]
+    assert saved["meta"]["answered_count"] == len(answers)
+    assert saved["meta"]["source"] == "ingest"
+
+
+def test_ingest_rejects_malformed_and_bad_ids(sessions_dir):
+    src = io.StringIO('{bad\n\n' + json.dumps({"session_id": "../x", "answers": {"p1_s1": "matter"}}) + "\n")
+    rejects = io.StringIO()
+    stats = app.ingest_ndjson(src, rejects)
+
+    assert stats["ok"] == 0 and stats["rejected"] == 2 and stats["skipped_blank"] == 1
+    lines = [json.loads(x) for x in rejects.getvalue().splitlines()]
+    assert [x["line"] for x in lines] == [1, 3]
+    assert "session_id" in lines[1]["error"]
+    assert list(sessions_dir.iterdir()) == []
+
+
+def test_ingest_rejects_duplicates(sessions_dir):
+    app.save_session({"meta": {"session_id": "ui"}, "ai_master_report": "keep me"})
+    rec = {"answers": {"p1_s1": "matter"}}
+    rejects = io.StringIO()
+    stats = app.ingest_ndjson(ndjson({**rec, "session_id": "dup"}, {**rec, "session_id": "dup"}, {**rec, "session_id": "ui"}), rejects, batch_size=1)
+
+    assert stats["ok"] == 1 and stats["rejected"] == 2
+    assert "--overwrite" in rejects.getvalue()
+    assert json.loads((sessions_dir / "ui.json").read_text(encoding="utf-8"))["ai_master_report"] == "keep me"
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 500])
+def test_ingest_overwrite_last_record_wins(sessions_dir, batch_size):
+    records = [
+        {"session_id": "dup", "answers": {"intake.name": "x" * (i * 37 % 500 + 1)}}
+        for i in range(100)
+    ]
+    stats = app.ingest_ndjson(ndjson(*records), io.StringIO(), batch_size=batch_size, overwrite=True)
+
+    # ok — реально записанные файлы; в пачке пишется только последняя запись с этим id
+    assert stats["ok"] + stats["overwritten"] == 100
+    assert stats["ok"] - stats["replaced"] == 1  # новых сессий на диске
+    if batch_size > 1:
+        assert stats == {**stats, "ok": 1, "overwritten": 99, "replaced": 0}
+    saved = json.loads((sessions_dir / "dup.json").read_text(encoding="utf-8"))
+    assert saved["answers"] == records[-1]["answers"]
+    assert [p.name for p in sessions_dir.iterdir()] == ["dup.json"]  # без временных файлов
+
+
+def test_ingest_main_survives_bad_utf8_and_deep_nesting(sessions_dir, tmp_path):
+    good = lambda sid: json.dumps({"session_id": sid, "answers": {"p1_s1": "matter"}}).encode("utf-8")
+    src = tmp_path / "in.ndjson"
+    src.write_bytes(b"\n".join([good("a"), b'{"answers": "\xff"}', b"[" * 100000, good("b")]) + b"\n")
+    rejects = tmp_path / "rejects.ndjson"
+
+    assert app.ingest_main([str(src), "--rejects", str(rejects)]) == 0
+
+    assert sorted(p.name for p in sessions_dir.glob("*.json")) == ["a.json", "b.json"]
+    lines = [json.loads(x) for x in rejects.read_text(encoding="utf-8").splitlines()]
+    assert [x["line"] for x in lines] == [2, 3]
+    assert lines[0]["error"].startswith("UnicodeDecodeError")
+    assert lines[1]["error"].startswith("RecursionError")
+
+
+def test_ingest_write_failure_is_rejected_not_counted(sessions_dir, monkeypatch):
+    real_save = app._save_compact
+
+    def flaky_save(payload):
+        if payload["meta"]["session_id"] == "bad":
+            raise OSError("No space left on device")
+        real_save(payload)
+
+    monkeypatch.setattr(app, "_save_compact", flaky_save)
+    rec = {"answers": {"p1_s1": "matter"}}
+    rejects = io.StringIO()
+    stats = app.ingest_ndjson(ndjson({**rec, "session_id": "ok1"}, {**rec, "session_id": "bad"}, {**rec, "session_id": "ok2"}), rejects, batch_size=2)
+
+    assert stats["ok"] == 2 and stats["failed"] == 1
+    failed = json.loads(rejects.getvalue())
+    assert failed["line"] == 2 and "bad" in failed["error"]
+    assert sorted(p.name for p in sessions_dir.glob("*.json")) == ["ok1.json", "ok2.json"]
@@ -0,0 +1,97 @@
+# tests/test_prompt.py
+import pytest
+
+import app
+
+
+def make_payload():
+    answers = {"intake.name": "Аня", "intake.contact": "a@b.c", "intake.request": "хочу понять себя " * 30}
+    for pos in range(1, 7):
+        answers[f"p{pos}_s1"] = "emotions"
+        answers[f"p{pos}_p1_emotions"] = "Рубин"
+        answers[f"p{pos}_p2_emotions"] = "Гранат"
+    return app.build_payload(answers, [], "sid")
+
+
+def test_prompt_table_is_compact_and_pii_free():
+    table = app.build_prompt_table(make_payload())
+    text = app.encode_prompt_table(table)
+
+    assert "meta" not in table
+    assert "Аня" not in text and "a@b.c" not in text
+    assert table["t"] == {"Рубин": 6, "Гранат": 6}  # только ненулевые, целые
+    assert set(table) == {"t", "cp", "cm", "ci", "p1", "p2", "p3", "p4", "p5", "p6", "rq"}
+    assert ": " not in text
+
+
+def test_no_budget_keeps_everything():
+    table = app.build_prompt_table(make_payload())
+    _, _, dropped = app.fit_prompt_to_budget(table, 0)
+    assert dropped == []
+
+
+def test_budget_drops_in_order():
+    table = app.build_prompt_table(make_payload())
+    full_text, full_tokens, _ = app.fit_prompt_to_budget(table, 0)
+
+    _, tokens, dropped = app.fit_prompt_to_budget(table, full_tokens - 1)
+    assert dropped == ["cp"]
+    assert tokens <= full_tokens - 1
+
+    # бюджет меньше system-промпта: выкидываем всё по порядку, кроме общего счёта
+    text, _, dropped = app.fit_prompt_to_budget(table, 1)
+    assert dropped == app.PROMPT_DROP_ORDER
+    assert app.encode_prompt_table({"t": table["t"]}) == text
+    assert "cp" in table  # исходная таблица не тронута
+
+
+def test_count_tokens_heuristic(monkeypatch):
+    monkeypatch.setattr(app, "TIKTOKEN_ENC", None)
+    assert app.count_tokens("") == 0
+    assert app.count_tokens("abcd") == 1
+    assert app.count_tokens("абвг") == 2  # 8 байт UTF-8
+
+
+class _FailingResponses:
+    def create(self, **kwargs):
+        raise RuntimeError("timeout")
+
+
+class _BadJsonResponses:
+    def create(self, **kwargs):
+        usage = type("U", (), {"input_tokens": 300, "output_tokens": 5})()
+        return type("R", (), {"usage": usage, "output_text": "not json"})()
+
+
+@pytest.mark.parametrize("responses, error", [(_FailingResponses(), RuntimeError), (_BadJsonResponses(), ValueError)])
+def test_usage_logged_on_failure(responses, error):
+    client = type("C", (), {"responses": responses})()
+    usage_log = []
+    with pytest.raises(error):
+        app.call_openai_for_reports(client, "gpt-4.1-mini", make_payload(), usage_log)
+
+    assert len(usage_log) == 1
+    rec = usage_log[0]
+    assert rec["error"] and rec["latency_ms"] is not None
+    if isinstance(responses, _BadJsonResponses):
+        assert rec["input_tokens"] == 300 and rec["output_tokens"] == 5
+
+
+@pytest.mark.parametrize("raw, expected", [("800", 800), (" 0 ", 0), ("lots", 1200), ("", 1200)])
+def test_int_setting_falls_back_on_garbage(monkeypatch, raw, expected):
+    monkeypatch.setenv("PROMPT_TOKEN_BUDGET", raw)
+    assert app.int_setting("PROMPT_TOKEN_BUDGET", 1200) == expected
+
+
+def test_tiktoken_cache_lookup(monkeypatch, tmp_path):
+    monkeypatch.setenv("TIKTOKEN_CACHE_DIR", str(tmp_path))
+    assert app._tiktoken_cache_file() is None
+
+    cached = tmp_path / app.hashlib.sha1(app.TIKTOKEN_URL.encode()).hexdigest()
+    cached.write_text("x")
+    assert app._tiktoken_cache_file() == cached
+
+    # пустой TIKTOKEN_CACHE_DIR у tiktoken = кэш выключен, DATA_GYM_CACHE_DIR не смотрим
+    monkeypatch.setenv("TIKTOKEN_CACHE_DIR", "")
+    monkeypatch.setenv("DATA_GYM_CACHE_DIR", str(tmp_path))
+    assert app._tiktoken_cache_file() is None
@@ -0,0 +1,51 @@
+# tests/test_session_cache.py
+import json
+
+import app
+
+
+def payload(sid, **extra):
+    return {"meta": {"session_id": sid}, "scores": {}, **extra}
+
+
+def test_cache_hit_and_invalidation(sessions_dir):
+    app.save_session(payload("a"))
+    entry = app.cached_session("a")
+    assert app.cached_session("a") is entry
+
+    app.save_session(payload("a", ai_master_report="new"))
+    fresh = app.cached_session("a")
+    assert fresh is not entry and fresh["payload"]["ai_master_report"] == "new"
+    assert app.cached_session("missing") is None
+
+
+def test_cache_is_bounded_lru(sessions_dir, monkeypatch):
+    monkeypatch.setattr(app, "SESSION_CACHE_SIZE", 3)
+    for sid in "abcd":
+        app.save_session(payload(sid))
+    for sid in "abca":
+        app.cached_session(sid)
+    app.cached_session("d")  # вытесняет b — самую давно использованную
+    assert list(app._session_cache()["lru"]) == ["c", "a", "d"]
+
+
+def test_download_is_indented_for_compact_files(sessions_dir):
+    app.save_session(payload("pretty"))
+    app.save_session(payload("compact"), indent=None)
+
+    pretty = app.cached_session("pretty")
+    assert app.cached_download(pretty) is pretty["raw"]
+
+    compact = app.cached_download(app.cached_session("compact"))
+    assert compact == json.dumps(payload("compact"), ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def test_list_session_metas(sessions_dir):
+    app.save_session(payload("a"))
+    app.save_session(payload("b"))
+    (sessions_dir / "broken.json").write_text("{", encoding="utf-8")
+    assert sorted(m["session_id"] for m in app.list_session_metas()) == ["a", "b"]
+
+    (sessions_dir / "a.json").unlink()
+    assert [m["session_id"] for m in app.list_session_metas()] == ["b"]
+    assert set(app._session_cache()["metas"]) == {"b.json"}